@@ -15,8 +15,10 @@
 import argparse
 import ctypes
 import logging
+import struct
 import sys
 import time
+from functools import cached_property
 
 import usb1
 
@@ -49,193 +51,238 @@ DEF_MODE_OF_OPERATION = 4
 
 LINAK_TIMEOUT = 1000
 
+# seconds between status polls while moving, and once close to the target
+POLL_INTERVAL = 0.2
+POLL_INTERVAL_NEAR = 0.05
+# distance to the target, in multiples of epsilon, considered as close
+POLL_NEAR_EPSILONS = 4
+
 HEIGHT_MOVE_DOWNWARDS = 32767
 HEIGHT_MOVE_UPWARDS = 32768
 HEIGHT_MOVE_END = 32769
 
+_U16_LE = struct.Struct('<H')
+_U16_BE = struct.Struct('>H')
+# pos (u16 LE), status (u8), speed (u8)
+_STATUS_POS_SPEED = struct.Struct('<HBB')
+# ref1 position at offset 4 and ref1cnt at offset 20 (u16 LE each)
+_REF1_POS_CNT = struct.Struct('<4xH14xH')
+# payload of status report sent by device which is not initialized yet
+_NOT_READY_ZEROS = bytes(LEN_STATUS_REPORT - 7)
+# requested height repeated for all four references (u16 LE each)
+_MOVE_REPEAT = struct.Struct('<HHHH')
+
+
+LOG = logging.getLogger(__name__)
+_LEVELS = (logging.CRITICAL,
+           logging.ERROR,
+           logging.WARNING,
+           logging.INFO,
+           logging.DEBUG)
 
-class Logger:
+
+def setup_logger():
     """
-    Simple logger class with output on console only
+    Set up console output for the logger and make it meaningful :)
     """
-    def __init__(self, logger_name):
-        """
-        Initialize named logger
-        """
-        self._log = logging.getLogger(logger_name)
-        self.setup_logger()
-        self._log.set_verbose = self.set_verbose
+    if LOG.handlers:
+        # need only one handler
+        return
 
-    def __call__(self):
-        """
-        Calling this object will return configured logging.Logger object with
-        additional set_verbose() method.
-        """
-        return self._log
+    console_handler = logging.StreamHandler(sys.stderr)
+    console_handler.set_name("console")
+    console_formatter = logging.Formatter("%(levelname)s: %(message)s")
+    console_handler.setFormatter(console_formatter)
+    LOG.addHandler(console_handler)
+    LOG.setLevel(logging.WARNING)
 
-    def set_verbose(self, verbose_level):
-        """
-        Change verbosity level. Default level is warning.
-        """
-        ver_map = {0: logging.CRITICAL,
-                   1: logging.ERROR,
-                   2: logging.WARNING,
-                   3: logging.INFO,
-                   4: logging.DEBUG}
-        self._log.setLevel(ver_map.get(verbose_level, ver_map[4]))
-
-    def setup_logger(self):
-        """
-        Create setup instance and make output meaningful :)
-        """
-        if self._log.handlers:
-            # need only one handler
-            return
 
-        console_handler = logging.StreamHandler(sys.stderr)
-        console_handler.set_name("console")
-        console_formatter = logging.Formatter("%(levelname)s: %(message)s")
-        console_handler.setFormatter(console_formatter)
-        self._log.addHandler(console_handler)
-        self._log.setLevel(logging.WARNING)
+def set_verbose(verbose_level):
+    """
+    Change verbosity level. Default level is warning.
+    """
+    LOG.setLevel(_LEVELS[min(verbose_level, len(_LEVELS) - 1)])
 
 
-LOG = Logger(__name__)()
+setup_logger()
 
 
 class Status(object):
-    positionLost = True
-    antiColision = True
-    overloadDown = True
-    overloadUp = True
-    unknown = 4
+    __slots__ = ('positionLost', 'antiColision', 'overloadDown', 'overloadUp',
+                 'unknown')
 
     @classmethod
-    def from_buf(cls, buf):
+    def from_buf(cls, byte):
         self = cls()
-        attr = ['positionLost', 'antiColision', 'overloadDown', 'overloadUp']
-        bitlist = '{:0>8s}'.format(bin(int(buf, base=16)).lstrip('0b'))
-        for index, attr_name in enumerate(attr):
-            setattr(self, attr_name, bitlist[index] == '1')
-        # set unknown
-        self.unknown = int(buf[1:], 16)
+        self.positionLost = bool(byte & 0x80)
+        self.antiColision = bool(byte & 0x40)
+        self.overloadDown = bool(byte & 0x20)
+        self.overloadUp = bool(byte & 0x10)
+        self.unknown = byte & 0x0F
 
         return self
 
 
 class StatusPositionSpeed(object):
-    pos = None
-    status = None
-    speed = 0
+    __slots__ = ('pos', 'status', 'speed')
 
     @classmethod
-    def from_buf(cls, buf):
+    def from_buf(cls, buf, offset):
         self = cls()
-        self.pos = int(buf[2:4] + buf[:2], 16)
-        self.status = Status.from_buf(buf[4:6])
-        self.speed = int(buf[6:8], 16)
+        self.pos, status, self.speed = _STATUS_POS_SPEED.unpack_from(buf,
+                                                                     offset)
+        self.status = Status.from_buf(status)
 
         return self
 
 
 class ValidFlags(object):
-    ID00_Ref1_pos_stat_speed = True
-    ID01_Ref2_pos_stat_speed = True
-    ID02_Ref3_pos_stat_speed = True
-    ID03_Ref4_pos_stat_speed = True
-    ID10_Ref1_controlInput = True
-    ID11_Ref2_controlInput = True
-    ID12_Ref3_controlInput = True
-    ID13_Ref4_controlInput = True
-    ID04_Ref5_pos_stat_speed = True
-    ID28_Diagnostic = True
-    ID05_Ref6_pos_stat_speed = True
-    ID37_Handset1command = True
-    ID38_Handset2command = True
-    ID06_Ref7_pos_stat_speed = True
-    ID07_Ref8_pos_stat_speed = True
-    unknown = True
+    __slots__ = ('ID00_Ref1_pos_stat_speed',
+                 'ID01_Ref2_pos_stat_speed',
+                 'ID02_Ref3_pos_stat_speed',
+                 'ID03_Ref4_pos_stat_speed',
+                 'ID10_Ref1_controlInput',
+                 'ID11_Ref2_controlInput',
+                 'ID12_Ref3_controlInput',
+                 'ID13_Ref4_controlInput',
+                 'ID04_Ref5_pos_stat_speed',
+                 'ID28_Diagnostic',
+                 'ID05_Ref6_pos_stat_speed',
+                 'ID37_Handset1command',
+                 'ID38_Handset2command',
+                 'ID06_Ref7_pos_stat_speed',
+                 'ID07_Ref8_pos_stat_speed',
+                 'unknown')
 
     @classmethod
-    def from_buf(cls, buf):
+    def from_buf(cls, buf, offset):
         self = cls()
-        attr = ['ID00_Ref1_pos_stat_speed',
-                'ID01_Ref2_pos_stat_speed',
-                'ID02_Ref3_pos_stat_speed',
-                'ID03_Ref4_pos_stat_speed',
-                'ID10_Ref1_controlInput',
-                'ID11_Ref2_controlInput',
-                'ID12_Ref3_controlInput',
-                'ID13_Ref4_controlInput',
-                'ID04_Ref5_pos_stat_speed',
-                'ID28_Diagnostic',
-                'ID05_Ref6_pos_stat_speed',
-                'ID37_Handset1command',
-                'ID38_Handset2command',
-                'ID06_Ref7_pos_stat_speed',
-                'ID07_Ref8_pos_stat_speed',
-                'unknown']
-        for idx, bit in enumerate(bin(int(buf, base=16))[2:].zfill(16)):
-            setattr(self, attr[idx], bit == '1')
+        word = _U16_BE.unpack_from(buf, offset)[0]
+        self.ID00_Ref1_pos_stat_speed = bool(word & 0x8000)
+        self.ID01_Ref2_pos_stat_speed = bool(word & 0x4000)
+        self.ID02_Ref3_pos_stat_speed = bool(word & 0x2000)
+        self.ID03_Ref4_pos_stat_speed = bool(word & 0x1000)
+        self.ID10_Ref1_controlInput = bool(word & 0x0800)
+        self.ID11_Ref2_controlInput = bool(word & 0x0400)
+        self.ID12_Ref3_controlInput = bool(word & 0x0200)
+        self.ID13_Ref4_controlInput = bool(word & 0x0100)
+        self.ID04_Ref5_pos_stat_speed = bool(word & 0x0080)
+        self.ID28_Diagnostic = bool(word & 0x0040)
+        self.ID05_Ref6_pos_stat_speed = bool(word & 0x0020)
+        self.ID37_Handset1command = bool(word & 0x0010)
+        self.ID38_Handset2command = bool(word & 0x0008)
+        self.ID06_Ref7_pos_stat_speed = bool(word & 0x0004)
+        self.ID07_Ref8_pos_stat_speed = bool(word & 0x0002)
+        self.unknown = bool(word & 0x0001)
 
         return self
 
 
 class StatusReport(object):
-    featureRaportID = 0
-    numberOfBytes = 0
-    validFlag = None
-    ref1 = None
-    ref2 = None
-    ref3 = None
-    ref4 = None
-    ref1cnt = 0
-    ref2cnt = 0
-    ref3cnt = 0
-    ref4cnt = 0
-    ref5 = None
-    diagnostic = None
-    undefined1 = None
-    handset1 = 0
-    handset2 = 0
-    ref6 = None
-    ref7 = None
-    ref8 = None
-    undefined2 = None
+    """
+    Status report decoded on demand. Only ref1 position and ref1cnt, which
+    are needed while moving the desk, are unpacked upfront; everything else
+    is decoded from the retained buffer on first access.
+    """
+    # __dict__ is kept for the cached_property values
+    __slots__ = ('_buf', 'ref1pos', 'ref1cnt', '__dict__')
+
+    def __init__(self, buf):
+        self._buf = buf
+        self.ref1pos, self.ref1cnt = _REF1_POS_CNT.unpack_from(buf)
 
     @classmethod
     def from_buf(cls, buf):
-        self = cls()
-        raw = buf.hex()
-        self.featureRaportID = buf[0]
-        self.numberOfBytes = buf[1]
-        self.validFlag = ValidFlags.from_buf(raw[4:8])
-        self.ref1 = StatusPositionSpeed.from_buf(raw[8:8+8])
-        self.ref2 = StatusPositionSpeed.from_buf(raw[16:16+8])
-        self.ref3 = StatusPositionSpeed.from_buf(raw[24:24+8])
-        self.ref4 = StatusPositionSpeed.from_buf(raw[32:32+8])
-        self.ref1cnt = int(raw[42:44] + raw[40:42], 16)
-        self.ref2cnt = int(raw[46:48] + raw[44:46], 16)
-        self.ref3cnt = int(raw[50:52] + raw[48:50], 16)
-        self.ref4cnt = int(raw[54:56] + raw[52:54], 16)
-        self.ref5 = StatusPositionSpeed.from_buf(raw[56:56+8])
-        self.diagnostic = raw[64:64+16]
-        self.undefined1 = raw[80:84]
-        self.handset1 = int(raw[86:88] + raw[84:86], 16)
-        self.handset2 = int(raw[88:90] + raw[86:88], 16)
-        self.ref6 = StatusPositionSpeed.from_buf(raw[90:90+8])
-        self.ref7 = StatusPositionSpeed.from_buf(raw[98:98+8])
-        self.ref8 = StatusPositionSpeed.from_buf(raw[106:106+8])
-        self.undefined2 = raw[114:]
+        return cls(buf)
 
-        return self
+    @property
+    def featureRaportID(self):
+        return self._buf[0]
+
+    @property
+    def numberOfBytes(self):
+        return self._buf[1]
+
+    @cached_property
+    def validFlag(self):
+        return ValidFlags.from_buf(self._buf, 2)
+
+    @cached_property
+    def ref1(self):
+        return StatusPositionSpeed.from_buf(self._buf, 4)
+
+    @cached_property
+    def ref2(self):
+        return StatusPositionSpeed.from_buf(self._buf, 8)
+
+    @cached_property
+    def ref3(self):
+        return StatusPositionSpeed.from_buf(self._buf, 12)
+
+    @cached_property
+    def ref4(self):
+        return StatusPositionSpeed.from_buf(self._buf, 16)
+
+    @cached_property
+    def ref2cnt(self):
+        return _U16_LE.unpack_from(self._buf, 22)[0]
+
+    @cached_property
+    def ref3cnt(self):
+        return _U16_LE.unpack_from(self._buf, 24)[0]
+
+    @cached_property
+    def ref4cnt(self):
+        return _U16_LE.unpack_from(self._buf, 26)[0]
+
+    @cached_property
+    def ref5(self):
+        return StatusPositionSpeed.from_buf(self._buf, 28)
+
+    @cached_property
+    def diagnostic(self):
+        return memoryview(self._buf)[32:40].hex()
+
+    @cached_property
+    def undefined1(self):
+        return memoryview(self._buf)[40:42].hex()
+
+    @cached_property
+    def handset1(self):
+        return _U16_LE.unpack_from(self._buf, 42)[0]
+
+    @cached_property
+    def handset2(self):
+        return _U16_LE.unpack_from(self._buf, 43)[0]
+
+    @cached_property
+    def ref6(self):
+        return StatusPositionSpeed.from_buf(self._buf, 45)
+
+    @cached_property
+    def ref7(self):
+        return StatusPositionSpeed.from_buf(self._buf, 49)
+
+    @cached_property
+    def ref8(self):
+        return StatusPositionSpeed.from_buf(self._buf, 53)
+
+    @cached_property
+    def undefined2(self):
+        return memoryview(self._buf)[57:].hex()
 
 
 class LinakController(object):
     _handle = None
     _ctx = None
+    _move_transfer = None
+    _status_transfer = None
 
     def __init__(self):
+        self._status_buf, self._status_data = self._alloc_report()
+        self._init_buf, self._init_data = self._alloc_report()
+        self._move_buf, self._move_data = self._alloc_report()
+
         self._ctx = usb1.USBContext()
         # self._ctx.setDebug(4)
         self._handle = self._ctx.openByVendorIDAndProductID(VENDOR_ID,
@@ -245,32 +292,82 @@ class LinakController(object):
             raise Exception('Could not connect to usb device')
 
         self._handle.claimInterface(0)
+        self._move_transfer = self._get_control_transfer(TYPE_SET_CI,
+                                                         HID_REPORT_SET,
+                                                         REQ_MOVE)
+        self._status_transfer = self._get_control_transfer(TYPE_GET_CI,
+                                                           HID_REPORT_GET,
+                                                           REQ_GET_STATUS)
         self._init_device()
 
     def close(self):
         if self._handle:
+            self._cancel_transfers()
             self._handle.releaseInterface(0)
 
         del self._handle
         del self._ctx
 
+    @staticmethod
+    def _alloc_report():
+        """
+        Return report buffer along with the ctypes array sharing its memory,
+        so it can be passed to libusb without copying.
+        """
+        buf = bytearray(LEN_STATUS_REPORT)
+        return buf, (ctypes.c_char * LEN_STATUS_REPORT).from_buffer(buf)
+
     def _control_write_read(self, request_type, request, value, index, data,
-                            timeout=0):
-        data, data_buffer = usb1.create_initialised_buffer(data)
+                            data_buffer, timeout=0):
         transferred = self._handle._controlTransfer(request_type, request,
                                                     value, index, data,
                                                     ctypes.sizeof(data),
                                                     timeout)
         return transferred, data_buffer[:transferred]
 
+    def _get_control_transfer(self, request_type, request, value):
+        """
+        Return asynchronous control transfer set up once with a report sized
+        buffer. It is resubmitted as is, with the payload written in place
+        into its buffer, so nothing is allocated per submission.
+        """
+        transfer = self._handle.getTransfer()
+        transfer.setControl(request_type, request, value, 0,
+                            LEN_STATUS_REPORT, timeout=LINAK_TIMEOUT)
+        return transfer
+
+    def _wait_for(self, *transfers):
+        """
+        Handle libusb events until none of the given transfers is pending.
+        """
+        while any(transfer.isSubmitted() for transfer in transfers):
+            self._ctx.handleEvents()
+
+    def _cancel_transfers(self):
+        """
+        Cancel asynchronous transfers which are still in flight.
+        """
+        transfers = [transfer for transfer in (self._move_transfer,
+                                               self._status_transfer)
+                     if transfer is not None and transfer.isSubmitted()]
+        for transfer in transfers:
+            try:
+                transfer.cancel()
+            except usb1.USBErrorNotFound:
+                # already completed, only not reaped by handleEvents yet
+                pass
+        self._wait_for(*transfers)
+
     def _get_status_report(self):
-        buf = bytearray(b'\x00' * LEN_STATUS_REPORT)
+        buf = self._status_buf
+        ctypes.memset(self._status_data, 0, LEN_STATUS_REPORT)
         buf[0] = CMD_STATUS_REPORT
         # print('> {:s}'.format(buf.hex()))
         _, buf = self._control_write_read(TYPE_GET_CI,
                                           HID_REPORT_GET,
                                           REQ_GET_STATUS,
                                           0,
+                                          self._status_data,
                                           buf,
                                           LINAK_TIMEOUT)
 
@@ -280,8 +377,33 @@ class LinakController(object):
 
         return buf
 
+    def _poll_status_report(self):
+        """
+        Asynchronous variant of _get_status_report, which also reaps move
+        command submitted by _submit_move, if any. Returned buffer belongs to
+        the transfer and is only valid until the next call.
+        """
+        transfer = self._status_transfer
+        move_pending = self._move_transfer.isSubmitted()
+        transfer.submit()
+        self._wait_for(self._move_transfer, transfer)
+
+        if (move_pending and
+                self._move_transfer.getStatus() != usb1.TRANSFER_COMPLETED):
+            raise Exception('Move command failed!')
+
+        if transfer.getStatus() != usb1.TRANSFER_COMPLETED:
+            raise Exception('Could not get status report!')
+
+        buf = transfer.getBuffer()[:transfer.getActualLength()]
+        if buf[0] != CMD_STATUS_REPORT:
+            raise Exception('Invalid status report received!')
+
+        return buf
+
     def _set_status_report(self):
-        buf = bytearray(b'\x00' * LEN_STATUS_REPORT)
+        buf = self._init_buf
+        ctypes.memset(self._init_data, 0, LEN_STATUS_REPORT)
         buf[0] = CMD_MODE_OF_OPERATION
         buf[1] = DEF_MODE_OF_OPERATION
         buf[2] = 0
@@ -291,6 +413,7 @@ class LinakController(object):
                                                HID_REPORT_SET,
                                                REQ_INIT,
                                                0,
+                                               self._init_data,
                                                buf,
                                                LINAK_TIMEOUT)
 
@@ -299,30 +422,32 @@ class LinakController(object):
                             'in step 1.')
 
     def _move(self, height):
-        buf = bytearray(b'\x00' * LEN_STATUS_REPORT)
+        buf = self._move_buf
+        ctypes.memset(self._move_data, 0, LEN_STATUS_REPORT)
         buf[0] = CMD_CONTROL_CBC
-
-        hHex = '{:04x}'.format(height)
-        hHigh = int(hHex[2:], 16)
-        hLow = int(hHex[:2], 16)
-
-        buf[1] = hHigh
-        buf[2] = hLow
-        buf[3] = hHigh
-        buf[4] = hLow
-        buf[5] = hHigh
-        buf[6] = hLow
-        buf[7] = hHigh
-        buf[8] = hLow
+        _MOVE_REPEAT.pack_into(buf, 1, height, height, height, height)
 
         amount, buf = self._control_write_read(TYPE_SET_CI,
                                                HID_REPORT_SET,
                                                REQ_MOVE,
                                                0,
+                                               self._move_data,
                                                buf,
                                                LINAK_TIMEOUT)
         return amount == LEN_STATUS_REPORT
 
+    def _submit_move(self, height):
+        """
+        Send move command without waiting for its completion; it is reaped
+        by the following _poll_status_report call.
+        """
+        transfer = self._move_transfer
+        # bytes past the heights are never written, so they stay zeroed
+        buf = transfer.getBuffer()
+        buf[0] = CMD_CONTROL_CBC
+        _MOVE_REPEAT.pack_into(buf, 1, height, height, height, height)
+        transfer.submit()
+
     def _move_down(self):
         return self._move(HEIGHT_MOVE_DOWNWARDS)
 
@@ -333,14 +458,9 @@ class LinakController(object):
         return self._move(HEIGHT_MOVE_END)
 
     def _is_status_report_not_ready(self, buf):
-        if buf[0] != CMD_STATUS_REPORT or buf[1] != NRB_STATUS_REPORT:
-            return False
-
-        for i in range(2, LEN_STATUS_REPORT - 5):
-            if buf[i] != 0:
-                return False
-
-        return True
+        return (buf[0] == CMD_STATUS_REPORT and
+                buf[1] == NRB_STATUS_REPORT and
+                buf[2:LEN_STATUS_REPORT - 5] == _NOT_READY_ZEROS)
 
     def _init_device(self):
         buf = self._get_status_report()
@@ -360,37 +480,55 @@ class LinakController(object):
     def move(self, target):
         retry_count = max_retry = 3
         epsilon = 13
-        prev_height = 0
+
+        pos, _ = self.get_height()
+        if abs(pos - target) <= epsilon:
+            # already there, nothing to do
+            return True
+
+        prev_height = None
+        interval = POLL_INTERVAL
 
         while True:
-            self._move(target)
-            time.sleep(0.2)
+            # no need to push the desk again once it's already near target
+            if prev_height is None or abs(target - prev_height) > epsilon:
+                self._submit_move(target)
+            time.sleep(interval)
 
-            buf = self._get_status_report()
+            buf = self._poll_status_report()
             r = StatusReport.from_buf(buf)
-            distance = r.ref1cnt - r.ref1.pos
-            delta = abs(prev_height - r.ref1.pos)
-            if (abs(distance) <= epsilon or delta <= epsilon or
-                    prev_height == r.ref1.pos):
+            distance = r.ref1cnt - r.ref1pos
+            # stall threshold is meant for POLL_INTERVAL between polls, scale
+            # it down accordingly when polling faster
+            stalled = (prev_height is not None and
+                       abs(prev_height - r.ref1pos) <=
+                       epsilon * interval / POLL_INTERVAL)
+            if abs(distance) <= epsilon or stalled:
                 retry_count -= 1
             else:
                 retry_count = max_retry
 
-            LOG.info('Current height: %s; target height: %s; '
-                     'distance: %s', r.ref1.pos, target, distance)
+            if LOG.isEnabledFor(logging.INFO):
+                LOG.info('Current height: %s; target height: %s; '
+                         'distance: %s', r.ref1pos, target, distance)
 
             if retry_count == 0:
                 break
 
-            prev_height = r.ref1.pos
+            prev_height = r.ref1pos
+            # poll more often when close to the target height
+            if abs(distance) < epsilon * POLL_NEAR_EPSILONS:
+                interval = POLL_INTERVAL_NEAR
+            else:
+                interval = POLL_INTERVAL
 
-        return abs(r.ref1.pos - target) <= epsilon
+        return abs(r.ref1pos - target) <= epsilon
 
     def get_height(self):
         buf = self._get_status_report()
         r = StatusReport.from_buf(buf)
 
-        return r.ref1.pos, r.ref1.pos/98.0
+        return r.ref1pos, r.ref1pos/98.0
 
 
 if __name__ == '__main__':
@@ -409,7 +547,7 @@ if __name__ == '__main__':
 
     args = parser.parse_args()
 
-    LOG.set_verbose(args.verbose)
+    set_verbose(args.verbose)
 
     co = LinakController()
     try: